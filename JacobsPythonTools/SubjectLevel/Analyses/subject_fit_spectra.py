@@ -3,6 +3,8 @@ Subsequent Memory Effect Analysis after correct for 1/f slope of the power spect
 For every electrode and frequency, compare correctly and incorrectly recalled items using a t-test.
 """
 import os
+import threading
+from functools import cached_property, lru_cache
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import numpy as np
@@ -11,9 +13,22 @@ import seaborn as sns
 import numexpr as ne
 import statsmodels.api as sm
 from mpl_toolkits.axes_grid1 import make_axes_locatable
-from scipy.stats import sem, ttest_ind
-from joblib import Parallel, delayed
-from fooof import FOOOF
+from scipy.linalg import cho_factor, cho_solve
+from scipy.special import stdtr
+from scipy.stats import sem
+from joblib import Parallel, delayed, parallel_config
+from fooof import FOOOFGroup
+
+# numba is optional. Without it, the aperiodic only fooof fit runs as plain python
+try:
+    from numba import njit, prange
+except ImportError:
+    prange = range
+
+    def njit(*args, **kwargs):
+        if (len(args) == 1) and callable(args[0]):
+            return args[0]
+        return lambda func: func
 
 from JacobsPythonTools.SubjectLevel.subject_analysis import SubjectAnalysisBase
 from JacobsPythonTools.SubjectLevel.subject_ram_power_data import SubjectRamPowerData
@@ -40,6 +55,10 @@ class SubjectFitSpectraAnalysis(SubjectAnalysisBase, SubjectRamPowerData):
         # See https://github.com/voytekresearch/fooof
         self.use_fooof = False
 
+        # The norm to use for the robust regression when not using fooof. None (or LeastSquares) is an ordinary least
+        # squares fit. Can be any statsmodels.robust.norms instance, such as sm.robust.norms.HuberT()
+        self.robust_norm = None
+
         # NOTE 1: fooof is too slow to realistically compute for every event, electrode, (and timebin, if present).
         # the default when using fooof is to only fit the mean power spectra for each condition. Change the parameter
         # if you feel like waiting a LONG time only.
@@ -48,6 +67,40 @@ class SubjectFitSpectraAnalysis(SubjectAnalysisBase, SubjectRamPowerData):
         # difference between the means of the conditions
         self.fooof_fit_each_event = False
 
+        # If True, only fit the fooof aperiodic (1/f) component, with a fast compiled version of fooof's fit instead of
+        # the full model. Resids are then the log power spectra minus the aperiodic fit. This makes it practical to use
+        # fooof_fit_each_event
+        self.fooof_aperiodic_only = False
+
+        # electrode sort orders and region groups for plot_elec_heat_map(), keyed by the sort columns
+        self._elec_sort_cache = {}
+
+    # clear the cached values derived from the frequencies whenever they change
+    @property
+    def freqs(self):
+        return self._freqs
+
+    @freqs.setter
+    def freqs(self, x):
+        SubjectRamPowerData.freqs.fset(self, x)
+        for attr in ['_log_freqs', '_design_matrix', '_pow_two_series']:
+            self.__dict__.pop(attr, None)
+
+    @cached_property
+    def _log_freqs(self):
+        return np.log10(self.freqs).astype(np.float32)
+
+    @cached_property
+    def _design_matrix(self):
+        """
+        Independent variable of the robust regression: log frequency with a constant column, as add_constant() would make.
+        """
+        return np.column_stack([np.ones_like(self._log_freqs), self._log_freqs])
+
+    @cached_property
+    def _pow_two_series(self):
+        return self.compute_pow_two_series()
+
     def _generate_res_save_path(self):
         self.res_save_dir = os.path.join(os.path.split(self.save_dir)[0], self.__class__.__name__+'_res')
 
@@ -67,76 +120,69 @@ class SubjectFitSpectraAnalysis(SubjectAnalysisBase, SubjectRamPowerData):
         # p_spects = self.normalize_power_spectrum()
         p_spects = self.subject_data.data
 
-        # and fit each channel and event. This parallelizes over whatever the last dimension
-        # if number of dimensions is 4, then we have time bins. We want to parallelize over channels or time, depending
-        # on which dimension is bigger. This will also help with memory usage of the stats down below
-        is_swapped = False
-        if (p_spects.ndim == 4) and (p_spects.shape[3] < p_spects.shape[2]):
-            p_spects = p_spects.swapaxes(2, 3)
-            is_swapped = True
+        # if number of dimensions is 4, then we have time bins. Everything below treats channels and time bins as one
+        # flattened dimension of events x frequencies x spectra, and the original shape is restored when storing results.
+        # The fits and stats run fastest on a contiguous float32 array
+        orig_shape = p_spects.shape
+        p_spects = np.ascontiguousarray(p_spects, dtype=np.float32).reshape(orig_shape[0], orig_shape[1], -1)
+        assert p_spects.strides[-1] == 4
 
-        # if we are using robust regression, add a constant column to the indep var
+        # if we are using robust regression, add a constant column to the indep var. The regression is vectorized, so
+        # fit every channel and event in a single call
         if not self.use_fooof:
-            f = robust_reg
-            x = sm.tools.tools.add_constant(np.log10(self.freqs))
+            x = self._design_matrix
+            slopes, offsets, resids = robust_reg(x, p_spects, norm=self.robust_norm)
 
         # if fooof, our indep var is just the freqs with no constant.
         # also, fooof wants the y vals not in log space, so undo if we have already logged the power values
         else:
-            f = run_foof
             x = self.freqs
-            if self.log_power:
-                p_spects = self.subject_data.data
-                p_spects = ne.evaluate("10**p_spects")
 
-            # only give fooof the mean of each condition.
+            # only give fooof the mean of each condition. This undoes the log a block of events at a time, so the full
+            # array of linear power values is never created
             if not self.fooof_fit_each_event:
-                p_spects = np.stack([p_spects[recalled].mean(axis=0), p_spects[~recalled].mean(axis=0)], 0)
+                p_spects = _linear_condition_means(p_spects, recalled, self.log_power)
 
-        # run the fitting procedure
-        res = Parallel(n_jobs=12, verbose=5)(delayed(f)(x, y.T) for y in p_spects.T)
+            # the aperiodic fit works in log space, so it can use log power values directly
+            if self.fooof_aperiodic_only:
+                is_log = self.log_power and self.fooof_fit_each_event
+                slopes, offsets, resids = fit_aperiodic(x, p_spects, is_log)
 
-        if (not self.use_fooof) or (self.use_fooof and self.fooof_fit_each_event):
+            # fooof is fit one spectrum at a time, so this is parallelized over all spectra
+            else:
+                if self.log_power and self.fooof_fit_each_event:
+                    p_spects = ne.evaluate("10**p_spects")
+                slopes, offsets, resids = par_run_foof(x, p_spects)
 
-            # for every frequency, electrode, timebin, subtract mean recalled from mean non-recalled
-            delta_resid = [np.nanmean(x[2][recalled], axis=0) - np.nanmean(x[2][~recalled], axis=0) for x in res]
-            delta_resid = np.stack(delta_resid, -1)
-            delta_slopes = [np.nanmean(x[0][recalled], axis=0) - np.nanmean(x[0][~recalled], axis=0) for x in res]
-            delta_slopes = np.stack(delta_slopes, -1)
-            delta_offsets = [np.nanmean(x[1][recalled], axis=0) - np.nanmean(x[1][~recalled], axis=0) for x in res]
-            delta_offsets = np.stack(delta_offsets, -1)
+        if (not self.use_fooof) or (self.use_fooof and self.fooof_fit_each_event):
 
-            # run ttest at each frequency and electrode comparing remembered and not remembered events on resids
-            ttest_resid = [ttest_ind(x[2][recalled], x[2][~recalled], axis=0) for x in res]
-            ts_resid = np.stack([x.statistic for x in ttest_resid], -1)
-            ps_resid = np.stack([x.pvalue for x in ttest_resid], -1)
+            # for every frequency, electrode, timebin, compare remembered and not remembered events on resids with a
+            # Welch's t-test, and subtract mean recalled from mean non-recalled. Each is a single pass over all
+            # frequencies, electrodes, and timebins
+            ts_resid, ps_resid, delta_resid = _welch_ttest(resids, recalled)
 
             # also compare slopes
-            ttest_slopes = [ttest_ind(x[0][recalled], x[0][~recalled], axis=0) for x in res]
-            ts_slopes = np.stack([x.statistic for x in ttest_slopes], -1)
-            ps_slopes = np.stack([x.pvalue for x in ttest_slopes], -1)
+            ts_slopes, ps_slopes, delta_slopes = _welch_ttest(slopes, recalled)
 
             # and offsets
-            ttest_slopes = [ttest_ind(x[1][recalled], x[1][~recalled], axis=0) for x in res]
-            ts_offsets = np.stack([x.statistic for x in ttest_slopes], -1)
-            ps_offsets = np.stack([x.pvalue for x in ttest_slopes], -1)
+            ts_offsets, ps_offsets, delta_offsets = _welch_ttest(offsets, recalled)
 
-            self.res['ts_resid'] = ts_resid if not is_swapped else np.swapaxes(ts_resid, 1, 2)
-            self.res['ps_resid'] = ps_resid if not is_swapped else np.swapaxes(ps_resid, 1, 2)
-            self.res['ts_slopes'] = ts_slopes if not is_swapped else np.swapaxes(ts_slopes, 0, 1)
-            self.res['ps_slopes'] = ps_slopes if not is_swapped else np.swapaxes(ps_slopes, 0, 1)
-            self.res['ts_offsets'] = ts_offsets if not is_swapped else np.swapaxes(ts_offsets, 0, 1)
-            self.res['ps_offsets'] = ps_offsets if not is_swapped else np.swapaxes(ps_offsets, 0, 1)
+            self.res['ts_resid'] = ts_resid.reshape(orig_shape[1:])
+            self.res['ps_resid'] = ps_resid.reshape(orig_shape[1:])
+            self.res['ts_slopes'] = ts_slopes.reshape(orig_shape[2:])
+            self.res['ps_slopes'] = ps_slopes.reshape(orig_shape[2:])
+            self.res['ts_offsets'] = ts_offsets.reshape(orig_shape[2:])
+            self.res['ps_offsets'] = ps_offsets.reshape(orig_shape[2:])
 
         elif self.use_fooof and not self.fooof_fit_each_event:
-            delta_resid = np.stack([x[2][0] - x[2][1] for x in res], -1)
-            delta_slopes = np.stack([x[0][0] - x[0][1] for x in res], -1)
-            delta_offsets = np.stack([x[1][0] - x[1][1] for x in res], -1)
-
-        # store results. Swap the axes back if we swapped them
-        self.res['delta_resid'] = delta_resid if not is_swapped else np.swapaxes(delta_resid, 1, 2)
-        self.res['delta_slopes'] = delta_slopes if not is_swapped else np.swapaxes(delta_slopes, 1, 2)
-        self.res['delta_offsets'] = delta_offsets if not is_swapped else np.swapaxes(delta_offsets, 1, 2)
+            delta_resid = resids[0] - resids[1]
+            delta_slopes = slopes[0] - slopes[1]
+            delta_offsets = offsets[0] - offsets[1]
+
+        # store results, restoring the channel and time bin dimensions
+        self.res['delta_resid'] = delta_resid.reshape(orig_shape[1:])
+        self.res['delta_slopes'] = delta_slopes.reshape(orig_shape[2:])
+        self.res['delta_offsets'] = delta_offsets.reshape(orig_shape[2:])
         self.res['p_recall'] = np.mean(recalled)
         self.res['recalled'] = recalled
 
@@ -164,9 +210,9 @@ class SubjectFitSpectraAnalysis(SubjectAnalysisBase, SubjectRamPowerData):
             print('%s: must enter a valid electrode label, as found in self.subject_data.channel' % self.subject)
             return
 
-        # normalize spectra
+        # normalize spectra, and keep only this electrode before splitting by condition
         recalled = self.res['recalled']
-        p_spect = self.normalize_power_spectrum()
+        p_elec = self.normalize_power_spectrum()[:, :, elec_ind].squeeze(-1)
 
         # create axis
         with plt.style.context('fivethirtyeight'):
@@ -176,20 +222,20 @@ class SubjectFitSpectraAnalysis(SubjectAnalysisBase, SubjectRamPowerData):
                 ax2 = plt.subplot2grid((3, 1), (2, 0), rowspan=1)
 
                 # will plot in log space
-                x = np.log10(self.subject_data.frequency)
+                x = self._log_freqs
 
                 ###############
                 ## Top panel ##
                 ###############
                 # recalled mean and err
-                rec_mean = np.mean(p_spect[recalled, :, elec_ind], axis=0)
-                rec_sem = sem(p_spect[recalled, :, elec_ind], axis=0)
+                rec_mean = np.mean(p_elec[recalled], axis=0)
+                rec_sem = sem(p_elec[recalled], axis=0)
                 ax1.plot(x, rec_mean, c='#8c564b', label='Good Memory', linewidth=2)
                 ax1.fill_between(x, rec_mean + rec_sem, rec_mean - rec_sem, color='#8c564b', alpha=.5)
 
                 # not recalled mean and err
-                nrec_mean = np.mean(p_spect[~recalled, :, elec_ind], axis=0)
-                nrec_sem = sem(p_spect[~recalled, :, elec_ind], axis=0)
+                nrec_mean = np.mean(p_elec[~recalled], axis=0)
+                nrec_sem = sem(p_elec[~recalled], axis=0)
                 ax1.plot(x, nrec_mean, color='#1f77b4', label='Bad Memory', linewidth=2)
                 ax1.fill_between(x, nrec_mean + nrec_sem, nrec_mean - nrec_sem, color='#1f77b4', alpha=.5)
 
@@ -222,7 +268,7 @@ class SubjectFitSpectraAnalysis(SubjectAnalysisBase, SubjectRamPowerData):
                 ax2.yaxis.set_ticks([-2, 0, 2])
 
                 # put powers of two on the x-axis for both panels
-                new_x = self.compute_pow_two_series()
+                new_x = self._pow_two_series
                 ax2.xaxis.set_ticks(np.log10(new_x))
                 ax2.xaxis.set_ticklabels(new_x, rotation=0)
                 ax1.xaxis.set_ticks(np.log10(new_x))
@@ -251,14 +297,8 @@ class SubjectFitSpectraAnalysis(SubjectAnalysisBase, SubjectRamPowerData):
 
         # group the electrodes by region, if we have the info
         do_region = True
-        if sortby_column1 and sortby_column2:
-            regions = self.elec_info[sortby_column1].fillna(self.elec_info[sortby_column2]).fillna(value='')
-            elec_order = np.argsort(regions)
-            groups = np.unique(regions)
-        elif sortby_column1:
-            regions = self.elec_info[sortby_column1].fillna(value='')
-            elec_order = np.argsort(regions)
-            groups = np.unique(regions)
+        if sortby_column1:
+            elec_order, groups, starts, ends = self._sort_elecs_by_region(sortby_column1, sortby_column2)
         else:
             elec_order = np.arange(self.elec_info.shape[0])
             do_region = False
@@ -289,15 +329,14 @@ class SubjectFitSpectraAnalysis(SubjectAnalysisBase, SubjectRamPowerData):
             # if plotting region info
             if do_region:
                 ax2 = divider.append_axes('top', size='3%', pad=0)
-                for i, this_group in enumerate(groups):
-                    x = np.where(regions[elec_order] == this_group)[0]
-                    ax2.plot([x[0] + .5, x[-1] + .5], [0, 0], '-', color=[.7, .7, .7])
-                    if len(x) > 1:
+                for this_group, start, end in zip(groups, starts, ends):
+                    ax2.plot([start + .5, end + .5], [0, 0], '-', color=[.7, .7, .7])
+                    if end > start:
                         if ' ' in this_group:
                             this_group = this_group.split()[0]+' '+''.join([x[0].upper() for x in this_group.split()[1:]])
                         else:
                             this_group = this_group[:12] + '.'
-                        plt.text(np.mean([x[0] + .5, x[-1] + .5]), 0.05, this_group,
+                        plt.text(np.mean([start + .5, end + .5]), 0.05, this_group,
                                  fontsize=14,
                                  horizontalalignment='center',
                                  verticalalignment='bottom', rotation=90)
@@ -306,78 +345,348 @@ class SubjectFitSpectraAnalysis(SubjectAnalysisBase, SubjectRamPowerData):
                 ax2.set_xticks([])
                 ax2.axis('off')
 
+    def _sort_elecs_by_region(self, sortby_column1, sortby_column2=''):
+        """
+        Sorts the electrodes by the region in sortby_column1, falling back to sortby_column2 where it is missing. Because
+        the sorted regions are contiguous, each region is found with a single np.unique() rather than a search per region.
+        Results are cached for each pair of columns until .elec_info changes.
+
+        Returns the electrode order, the region names, and the first and last position of each region in the order.
+        """
+        if self._elec_sort_cache.get('elec_info') is not self.elec_info:
+            self._elec_sort_cache = {'elec_info': self.elec_info}
+
+        key = (sortby_column1, sortby_column2)
+        if key not in self._elec_sort_cache:
+            regions = self.elec_info[sortby_column1]
+            if sortby_column2:
+                regions = regions.fillna(self.elec_info[sortby_column2])
+            regions = regions.fillna(value='').values
+
+            elec_order = np.argsort(regions, kind='stable')
+            groups, starts = np.unique(regions[elec_order], return_index=True)
+            ends = np.r_[starts[1:], len(regions)] - 1
+            self._elec_sort_cache[key] = (elec_order, groups, starts, ends)
+        return self._elec_sort_cache[key]
+
     def compute_pow_two_series(self):
         """
-        This convoluted line computes a series powers of two up to and including one power higher than the
-        frequencies used. Will use this as our axis ticks and labels so we can have nice round values.
+        Computes a series powers of two up to and including one power higher than the frequencies used. Will use this as
+        our axis ticks and labels so we can have nice round values.
         """
-        return np.power(2, range(int(np.log2(2 ** (int(self.freqs[-1]) - 1).bit_length())) + 1))
+        n = (int(self.freqs[-1]) - 1).bit_length()
+        return np.array([1 << k for k in range(n + 1)], dtype=np.int64)
 
 
-def run_foof(x, y):
+def _condition_moments(x, recalled, means_only=False, block_size=1024):
+    """
+    Means, variances, and counts of x over its first axis (num obs), computed separately for recalled and not recalled
+    items and ignoring NaNs. To keep the float64 copies small, x is processed in blocks along its second axis, each
+    covering about block_size of its spectra. In each block, the sums of both conditions come from a single einsum with
+    a num obs x 2 weight matrix, and the variances from the sums of squared deviations from each condition's mean. If
+    means_only, the variances are skipped.
+
+    Returns means, variances (None if means_only), and counts, each of shape (2,) + x.shape[1:], with recalled first.
+    """
+    weights = np.stack([recalled, ~recalled], axis=1).astype(np.float64)
+    means = np.empty((2,) + x.shape[1:])
+    variances = None if means_only else np.empty((2,) + x.shape[1:])
+    counts = np.empty((2,) + x.shape[1:])
+
+    step = max(1, block_size // int(np.prod(x.shape[2:])))
+    for start in range(0, x.shape[1], step):
+        block = x[:, start:start + step].astype(np.float64)
+        block_means = means[:, start:start + step]
+        block_counts = counts[:, start:start + step]
+
+        # mask out NaNs, only when the block has any
+        is_finite = np.isfinite(block)
+        has_nans = not is_finite.all()
+        if has_nans:
+            block[~is_finite] = 0
+            block_counts[:] = _weighted_sums(is_finite, weights)
+        else:
+            block_counts[:] = weights.sum(axis=0).reshape((2,) + (1,) * (x.ndim - 1))
+        block_means[:] = _weighted_sums(block, weights) / block_counts
+
+        if not means_only:
+            for cond in range(2):
+                devs = block - block_means[cond]
+                if has_nans:
+                    devs[~is_finite] = 0
+                np.square(devs, out=devs)
+                variances[cond, start:start + step] = _weighted_sums(devs, weights[:, cond:cond + 1])[0]
+    if not means_only:
+        variances /= counts - 1
+    return means, variances, counts
+
+
+def _weighted_sums(x, weights):
+    """
+    Sums of x over its first axis for each column of weights (num obs x k). Returns shape (k,) + x.shape[1:]
+    """
+    return np.einsum('e...,ek->k...', x, weights, optimize='greedy')
+
+
+def _welch_ttest(x, recalled):
+    """
+    Welch's t-test comparing recalled and not recalled items along the first axis of x, ignoring NaNs. Equivalent to
+    scipy.stats.ttest_ind(equal_var=False, nan_policy='omit'), but reuses the condition means for the difference.
+
+    Returns t-stats, p-values, and the mean recalled minus mean not recalled, each of shape x.shape[1:]
+    """
+    # with fewer than two items in a condition there is no variance to test, so only compute the difference of means
+    n_recalled = np.sum(recalled)
+    if (n_recalled < 2) or (len(recalled) - n_recalled < 2):
+        with np.errstate(invalid='ignore'):
+            means = _condition_moments(x, recalled, means_only=True)[0]
+        nans = np.full(x.shape[1:], np.nan, dtype=x.dtype)
+        return nans, nans.copy(), (means[0] - means[1]).astype(x.dtype)
+
+    means, variances, counts = _condition_moments(x, recalled)
+    se_sqs = variances / counts
+
+    # Welch-Satterthwaite degrees of freedom
+    se_sq = se_sqs.sum(axis=0)
+    df = se_sq ** 2 / (se_sqs ** 2 / (counts - 1)).sum(axis=0)
+
+    delta = means[0] - means[1]
+    ts = delta / np.sqrt(se_sq)
+    ps = 2 * stdtr(df, -np.abs(ts))
+    return ts.astype(x.dtype), ps.astype(x.dtype), delta.astype(x.dtype)
+
+
+def _linear_condition_means(p_spects, recalled, is_log, block_size=64):
+    """
+    Mean power spectrum of the recalled and not recalled items. If is_log, the power values are log10 and are converted
+    back to linear power before averaging. The conversion is done block_size events at a time into a reused buffer, and
+    each block is added to running sums of the two conditions.
+
+    Returns an array of shape (2,) + p_spects.shape[1:], with the recalled mean first.
+    """
+    sums = np.zeros((2,) + p_spects.shape[1:], dtype=p_spects.dtype)
+    buf = np.empty((block_size,) + p_spects.shape[1:], dtype=p_spects.dtype)
+
+    for start in range(0, p_spects.shape[0], block_size):
+        block = p_spects[start:start + block_size]
+        if is_log:
+            ne.evaluate("10**block", out=buf[:block.shape[0]])
+            block = buf[:block.shape[0]]
+
+        # sum each condition separately, so non-finite values in one condition can't reach the other's mean
+        rec_block = recalled[start:start + block_size]
+        sums[0] += block[rec_block].sum(axis=0)
+        sums[1] += block[~rec_block].sum(axis=0)
+
+    counts = np.array([np.sum(recalled), np.sum(~recalled)])
+    return sums / counts.reshape((2,) + (1,) * (p_spects.ndim - 1))
+
+
+# holds one FOOOFGroup per worker thread, so it is created once and reused by every run_foof() call
+_fooof_local = threading.local()
+
+
+def _get_fooof():
+    """
+    Returns this thread's FOOOFGroup, creating it on first use.
+    """
+    if not hasattr(_fooof_local, 'fg'):
+        _fooof_local.fg = FOOOFGroup(peak_width_limits=[1.0, 8.0], peak_threshold=0.5)
+    return _fooof_local.fg
+
+
+def par_run_foof(x, y, n_jobs=12):
     """
-    Fits the FOOOF (fitting oscillations & one over f) model.
+    Fits the FOOOF model to every spectrum in y (num obs x num features, with optional trailing dimensions). The spectra
+    are flattened and split into one contiguous chunk per job, so each worker receives only its own spectra and fits them
+    all with its reused FOOOFGroup.
 
     Returns slopes (num obs), offsets (num obs), and the peak fit power spectra (num obs x num features)
     """
-    res_shape = (y.shape[0], y.shape[-1]) if y.ndim == 3 else y.shape[0]
-    slopes = np.full(res_shape, np.nan, dtype='float32')
-    offsets = np.full(res_shape, np.nan, dtype='float32')
+    res_shape = y.shape[:1] + y.shape[2:]
+    spects = np.moveaxis(y, 1, -1).reshape(-1, y.shape[1])
+    chunks = np.array_split(spects, min(n_jobs, spects.shape[0]))
+
+    slopes = np.empty(spects.shape[0], dtype='float32')
+    offsets = np.empty(spects.shape[0], dtype='float32')
+    resids = np.empty(spects.shape, dtype='float32')
+
+    # limit each worker to one BLAS thread so the workers don't oversubscribe the cores. Results are consumed as they
+    # arrive and copied into their slice of the preallocated outputs, so the list of all chunk fits is never held
+    with parallel_config(backend='loky', inner_max_num_threads=1):
+        res = Parallel(n_jobs=n_jobs, verbose=5, return_as='generator')(delayed(run_foof)(x, chunk) for chunk in chunks)
+        start = 0
+        for chunk_slopes, chunk_offsets, chunk_resids in res:
+            stop = start + chunk_slopes.shape[0]
+            slopes[start:stop] = chunk_slopes
+            offsets[start:stop] = chunk_offsets
+            resids[start:stop] = chunk_resids
+            del chunk_slopes, chunk_offsets, chunk_resids
+            start = stop
+
+    resids = resids.reshape(res_shape + y.shape[1:2])
+    return slopes.reshape(res_shape), offsets.reshape(res_shape), np.moveaxis(resids, -1, 1)
+
+
+def run_foof(x, y):
+    """
+    Fits the FOOOF (fitting oscillations & one over f) model to each power spectrum in y (num spectra x num features),
+    using a FOOOFGroup to fit all of them in one call.
+
+    Returns slopes (num spectra), offsets (num spectra), and the peak fit power spectra (num spectra x num features)
+    """
+    slopes = np.full(y.shape[0], np.nan, dtype='float32')
+    offsets = np.full(y.shape[0], np.nan, dtype='float32')
     resids = np.full(y.shape, np.nan, dtype='float32')
 
-    # initialize foof
-    fm = FOOOF(peak_width_limits=[1.0, 8.0], peak_threshold=0.5)
-
-    for i, this_event in enumerate(y):
-        if this_event.ndim == 2:
-            freq_dim = np.array([n == len(x) for n in this_event.shape])
-            freq_dim_num = np.where(freq_dim)[0][0]
-            if freq_dim_num == 0:
-                this_event = this_event.T
-            for j, this_event_sub in enumerate(this_event):
-                fm.add_data(x, y)
-                fm.fit()
-                offsets[i, j] = fm.background_params_[0]
-                slopes[i, j] = fm.background_params_[1]
-                resids[i, :, j] = fm._peak_fit
-        else:
-            fm.add_data(x, this_event)
-            fm.fit()
-            offsets[i] = fm.background_params_[0]
-            slopes[i] = fm.background_params_[1]
-            resids[i] = fm._peak_fit
+    # parallelization is handled by the caller, so fit the group in serial. Fitting clears any previous data and results
+    fg = _get_fooof()
+    fg.fit(x, y, n_jobs=1)
+    if not fg.has_model:
+        return slopes, offsets, resids
+
+    ap_params = fg.get_params('aperiodic_params')
+    offsets[:] = ap_params[:, 0]
+    slopes[:] = ap_params[:, -1]
+
+    # rebuild the peak fit of each spectrum by summing the gaussians of its peaks. Spectra that failed to fit stay NaN
+    resids[~np.isnan(offsets)] = 0.
+    ctr, hgt, wid, ind = fg.get_params('gaussian_params').T
+    gaussians = hgt[:, None] * np.exp(-(fg.freqs - ctr[:, None]) ** 2 / (2 * wid[:, None] ** 2))
+    np.add.at(resids, ind.astype(int), gaussians)
 
     return slopes, offsets, resids
 
 
-def robust_reg(x, y):
+def fit_aperiodic(x, y, is_log=False):
+    """
+    Fits only the aperiodic component of the FOOOF model (fixed mode, no knee) to every spectrum in y (num obs x num
+    features, with optional trailing dimensions). If is_log, y is log10 power, otherwise y is power.
+
+    Returns slopes (num obs), offsets (num obs), and the residuals from the aperiodic fit (num obs x num features)
+    """
+    res_shape = y.shape[:1] + y.shape[2:]
+    log_p = np.moveaxis(y, 1, -1).reshape(-1, y.shape[1])
+    if not is_log:
+        log_p = np.log10(log_p)
+
+    log_f = np.log10(x).astype(np.float64)
+    log_p = np.ascontiguousarray(log_p, dtype=np.float64)
+    slopes, offsets = _aperiodic_fit_batch(log_f, log_p)
+    resids = log_p - (offsets[:, None] - slopes[:, None] * log_f)
+
+    resids = np.moveaxis(resids.reshape(res_shape + y.shape[1:2]), -1, 1).astype('float32')
+    return slopes.reshape(res_shape).astype('float32'), offsets.reshape(res_shape).astype('float32'), resids
+
+
+@njit(parallel=True)
+def _aperiodic_fit_batch(log_f, log_p):
     """
-    Fits a robust regression, looping over each entry in y.
+    Fits the fixed mode FOOOF aperiodic component, log_p = offset - exponent * log_f, to each row of log_p. Like FOOOF,
+    this is an initial fit followed by a refit to only the frequencies at or below the initial fit, so that peaks do not
+    bias the estimate. The model is linear in log-log space, so both fits are solved in closed form rather than with
+    curve_fit.
+
+    Returns exponents and offsets (num spectra). These are NaN for spectra that can't be fit, such as those with
+    non-finite values or with fewer than two frequencies left for the refit.
+    """
+    n_spects = log_p.shape[0]
+    exponents = np.empty(n_spects)
+    offsets = np.empty(n_spects)
+
+    for i in prange(n_spects):
+        offset, slope = _line_fit(log_f, log_p[i], np.ones(log_f.shape[0], dtype=np.bool_))
+
+        # FOOOF's robust fit: flatten the spectrum and keep frequencies below its 0.025 percentile
+        flat = log_p[i] - (offset + slope * log_f)
+        flat[flat < 0] = 0.
+        offset, slope = _line_fit(log_f, log_p[i], flat <= np.percentile(flat, 0.025))
+
+        offsets[i] = offset
+        exponents[i] = -slope
+    return exponents, offsets
+
+
+@njit
+def _line_fit(x, y, mask):
+    """
+    Least squares line through the points of x and y where mask is True. Returns the intercept and slope, or NaNs if
+    fewer than two distinct points are masked in.
+    """
+    n = sum_x = sum_y = sum_xx = sum_xy = 0.
+    for j in range(x.shape[0]):
+        if mask[j]:
+            n += 1
+            sum_x += x[j]
+            sum_y += y[j]
+            sum_xx += x[j] * x[j]
+            sum_xy += x[j] * y[j]
+
+    # like FOOOF's sub-sampling error, a line can't be fit to fewer than two distinct frequencies, so return NaN
+    denom = n * sum_xx - sum_x * sum_x
+    if (n < 2) or (denom == 0):
+        return np.nan, np.nan
+    slope = (n * sum_xy - sum_x * sum_y) / denom
+    return (sum_y - slope * sum_x) / n, slope
+
+
+def robust_reg(x, y, norm=None, max_iter=50, tol=1e-6):
+    """
+    Fits a regression of every observation in y onto the design matrix x, solving for all observations at once.
+
+    y is num obs x num features, optionally with additional trailing dimensions (channels, timebins) that are treated
+    as more observations. With the default norm (None or LeastSquares), this is ordinary least squares and is solved in
+    closed form. Otherwise, norm should be a statsmodels.robust.norms instance, and the fit is done with iteratively
+    reweighted least squares, reweighting every observation in the same pass.
 
     Returns slopes (num obs), offsets (num obs), and residuals (num obs x num features)
     """
-    res_shape = (y.shape[0], y.shape[-1]) if y.ndim == 3 else y.shape[0]
-    slopes = np.full(res_shape, np.nan, dtype='float32')
-    offsets = np.full(res_shape, np.nan, dtype='float32')
-    resids = np.full(y.shape, np.nan, dtype='float32')
+    # move the features to the first axis and collapse everything else, so each column of Y is one spectrum
+    res_shape = y.shape[:1] + y.shape[2:]
+    Y = np.moveaxis(y, 1, 0).reshape(y.shape[1], -1)
+
+    # one solve of the normal equations for all columns, reusing the factorization of x.T @ x
+    beta = cho_solve(_cached_xtx_chol(tuple(map(tuple, x))), x.T @ Y, check_finite=False)
+    if (norm is not None) and not isinstance(norm, sm.robust.norms.LeastSquares):
+        beta = _irls(x, Y, beta, norm, max_iter, tol)
+
+    offsets = beta[0].reshape(res_shape).astype('float32')
+    slopes = beta[1].reshape(res_shape).astype('float32')
+    resids = (Y - x @ beta).reshape(y.shape[1:2] + res_shape)
+    resids = np.moveaxis(resids, 0, 1).astype('float32')
+    return slopes, offsets, resids
 
-    for i, this_event in enumerate(y):
-        if this_event.ndim == 2:
-            freq_dim = np.array([n == len(x) for n in this_event.shape])
-            freq_dim_num = np.where(freq_dim)[0][0]
-            if freq_dim_num == 0:
-                this_event = this_event.T
-            for j, this_event_sub in enumerate(this_event):
-                rlm = sm.robust.robust_linear_model.RLM(this_event_sub, x,
-                                                       M=sm.robust.norms.LeastSquares())
-                rlm_results = rlm.fit()
-                offsets[i,j] = rlm_results.params[0]
-                slopes[i,j] = rlm_results.params[1]
-                resids[i, :, j] = rlm_results.resid
-        else:
-            rlm = sm.robust.robust_linear_model.RLM(this_event, x, M=sm.robust.norms.LeastSquares())
-            rlm_results = rlm.fit()
-            offsets[i] = rlm_results.params[0]
-            slopes[i] = rlm_results.params[1]
-            resids[i] = rlm_results.resid
-    return slopes, offsets, resids
\ No newline at end of file
+
+@lru_cache(maxsize=8)
+def _cached_xtx_chol(x_rows):
+    """
+    Cholesky factorization of x.T @ x for the design matrix x, given as a tuple of rows so that it can be cached. The
+    design matrix only depends on the frequencies, so this is shared by every fit with the same frequencies.
+    """
+    x = np.array(x_rows)
+    return cho_factor(x.T @ x)
+
+
+def _irls(x, Y, beta, norm, max_iter, tol):
+    """
+    Iteratively reweighted least squares for every column of Y at once, starting from the coefficients in beta. Each
+    iteration builds a features x columns weight matrix and solves the weighted normal equations of all columns together.
+    """
+    for _ in range(max_iter):
+        resid = Y - x @ beta
+
+        # guard against a zero scale when a column is fit perfectly
+        scale = sm.robust.scale.mad(resid, axis=0, center=0)
+        scale[scale == 0] = 1.
+        w = norm.weights(resid / scale)
+
+        # columns x params x params and columns x params weighted normal equations
+        xtwx = np.einsum('fi,fj,fk->kij', x, x, w)
+        xtwy = np.einsum('fi,fk->ki', x, w * Y)
+        new_beta = np.linalg.solve(xtwx, xtwy[..., None])[..., 0].T
+
+        converged = np.max(np.abs(new_beta - beta)) < tol
+        beta = new_beta
+        if converged:
+            break
+    return beta
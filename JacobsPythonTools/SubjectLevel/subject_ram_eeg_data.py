@@ -63,11 +63,12 @@ class SubjectRamEEGData(SubjectDataBase):
 
     def load_data(self):
         """
-        Call super's load data, and then additionally cast data to float32 to take up less space.
+        Call super's load data, and then additionally cast data to float32 to take up less space. Data that are already
+        float32 are not copied, so data loaded from disk stay memory-mapped.
         """
         super(SubjectRamEEGData, self).load_data()
         if self.subject_data is not None:
-            self.subject_data.data = self.subject_data.data.astype('float32')
+            self.subject_data.data = self.subject_data.data.astype('float32', copy=False)
             self.elec_info = ecog_helpers.load_elec_info(self.subject, self.montage, self.bipolar)
 
     def compute_data(self):
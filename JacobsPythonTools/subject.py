@@ -141,7 +141,8 @@ class SubjectDataBase(object):
 
     def load_data(self):
         """
-        Can load data if it exists, or can compute data.
+        Can load data if it exists, or can compute data. Data loaded from disk are memory-mapped read-only, so copy them
+        before modifying in place.
 
         This sets .subject_data after loading
         """
@@ -157,7 +158,7 @@ class SubjectDataBase(object):
 
                 if self.load_data_if_file_exists:
                     print('%s: subject_data already exists, loading.' % self.subject)
-                    self.subject_data = joblib.load(self.save_file)
+                    self.subject_data = joblib.load(self.save_file, mmap_mode='r')
                 else:
                     print('%s: subject_data exists, but redoing anyway.' % self.subject)
 
@@ -203,8 +204,8 @@ class SubjectDataBase(object):
             except OSError:
                 pass
 
-        # pickle file
-        joblib.dump(self.subject_data, self.save_file)
+        # pickle file. Uncompressed so that it can be memory-mapped when loaded
+        joblib.dump(self.subject_data, self.save_file, compress=0, protocol=4)
 
     def compute_data(self):
         """